@@ -2,137 +2,473 @@
 Calculate minimal distances between sequences in an alignment and a set of focal sequences
 """
 import argparse
-from augur.io import read_sequences
-from random import shuffle
-from collections import defaultdict
-import Bio
+from augur.io import open_file
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
 import numpy as np
-from Bio.SeqIO.FastaIO import SimpleFastaParser
-from Bio.Seq import Seq
-from Bio import AlignIO, SeqIO
-from scipy import sparse
+import mmap
 import sys
 
-
-def compactify_sequences(sparse_matrix, sequence_names):
-    sequence_groups = defaultdict(list)
-    for s, snps in zip(sequence_names, sparse_matrix):
-        ind = snps.nonzero()
-        vals = np.array(snps[ind])
-        if len(ind[1]):
-            sequence_groups[tuple(zip(ind[1], vals[0]))].append(s)
-        else:
-            sequence_groups[tuple()].append(s)
-
-    return sequence_groups
-
-INITIALISATION_LENGTH = 1000000
-
-def sequence_to_int_array(s, fill_value=110, fill_gaps=True):
-    seq = np.frombuffer(str(s).lower().encode('utf-8'), dtype=np.int8).copy()
-    if fill_gaps:
-        seq[(seq!=97) & (seq!=99) & (seq!=103) & (seq!=116)] = fill_value
+try:
+    from numba import config, njit, prange, set_num_threads, types
+    from numba.extending import intrinsic
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # Without Numba the kernels below are never called and NumPy counterparts are used instead
+    NUMBA_AVAILABLE = False
+    def njit(*args, **kwargs):
+        return lambda f: f
+    intrinsic = njit()
+    prange = range
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+def parse_fasta(lines):
+    # yield (name, sequence) tuples from lines of bytes, sequences stay bytes
+    name = None
+    seq_lines = []
+    for line in lines:
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, b''.join(seq_lines)
+            name = (line[1:].split(None, 1) or [b''])[0].decode('utf-8')
+            seq_lines = []
+        elif name is not None:
+            seq_lines.append(line.rstrip())
+    if name is not None:
+        yield name, b''.join(seq_lines)
+
+def parse_fasta_mmap(mm):
+    # Same as parse_fasta for a memory-mapped file starting with '>'. The sequence of a record on
+    # a single line is yielded as a view into the map without a copy, which is released once the
+    # next record is read. Sequences wrapped over several lines are joined into new bytes.
+    size = len(mm)
+    pos = 0
+    with memoryview(mm) as view:
+        while pos < size:
+            end = mm.find(b'\n', pos)
+            if end < 0:
+                end = size
+            name = (mm[pos + 1:end].split(None, 1) or [b''])[0].decode('utf-8')
+            # the record ends where the next line starts with '>'
+            next_record = mm.find(b'\n>', end)
+            start = end + 1
+            stop = size if next_record < 0 else next_record
+            while stop > start and mm[stop - 1] in b' \t\n\r\x0b\x0c':
+                stop -= 1
+            if mm.find(b'\n', start, stop) < 0:
+                seq = view[start:stop]
+            else:
+                seq = memoryview(b''.join(line.rstrip() for line in mm[start:stop].split(b'\n')))
+            try:
+                yield name, seq
+            finally:
+                seq.release()
+            pos = size if next_record < 0 else next_record + 1
+
+def read_fasta(fname):
+    # Uncompressed files are memory-mapped, compressed ones are decompressed with augur's open_file.
+    # A sequence is only valid until the next record is read or the file is closed.
+    with open(fname, 'rb') as fh:
+        uncompressed = fh.read(1) == b'>'
+        if uncompressed:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from parse_fasta_mmap(mm)
+    if not uncompressed:
+        with open_file(fname, 'rb') as fh:
+            yield from parse_fasta(fh)
+
+INITIALISATION_LENGTH = 1000
+
+@lru_cache(maxsize=None)
+def nucleotide_lut(fill_value=110, fill_gaps=True):
+    # lookup table mapping every byte to its lower case nucleotide or to fill_value
+    lut = np.full(256, fill_value, dtype=np.int8)
+    for nuc in b'acgt':
+        lut[nuc] = nuc
+        lut[nuc - 32] = nuc
+    if not fill_gaps:
+        lut[45] = 45
+    return lut
+
+@njit(nogil=True, cache=True)
+def translate_kernel(buf, lut, out):
+    for i in range(buf.shape[0]):
+        out[i] = lut[buf[i]]
+
+def sequence_to_int_array(s, fill_value=110, fill_gaps=True, out=None):
+    # s are the raw bytes of the sequence, which numpy reads without a copy
+    buf = np.frombuffer(s, dtype=np.uint8)
+    if out is None:
+        out = np.empty(buf.shape[0], dtype=np.int8)
+    lut = nucleotide_lut(fill_value, fill_gaps)
+    if NUMBA_AVAILABLE:
+        translate_kernel(buf, lut, out)
     else:
-        seq[(seq!=97) & (seq!=99) & (seq!=103) & (seq!=116) & (seq!=45)] = fill_value
-    return seq
+        np.take(lut, buf, out=out)
+    return out
+
+# 2-bit codes of the nucleotides, every other character is coded as ambiguous (4)
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+BASE_CODES[[97, 99, 103, 116]] = [0, 1, 2, 3]
+
+def ambiguous_words(consensus):
+    # indices of the words (of 64 sites) that contain ambiguous sites of the consensus
+    return np.unique(np.flatnonzero(BASE_CODES[consensus.view(np.uint8)] == 4)//64)
+
+@njit(nogil=True, cache=True)
+def pack_sequence_kernel(seq, consensus, fill_value, mask_words, hi, lo, mask):
+    # Pack a sequence into two bit-planes with 64 sites per word holding the high and low bit
+    # of the 2-bit nucleotide code. Filled sites take the consensus base, such that only
+    # differences to the consensus contribute to distances. Sites that remain ambiguous, i.e.
+    # where the consensus itself is ambiguous, are coded like 'a' and flagged in a mask that
+    # only holds the words listed in mask_words (none for a complete reference).
+    # Returns the number of filled sites.
+    filled = 0
+    k = 0
+    for w in range(hi.shape[0]):
+        hi_word = np.uint64(0)
+        lo_word = np.uint64(0)
+        mask_word = np.uint64(0)
+        for pos in range(w*64, min(w*64 + 64, seq.shape[0])):
+            nuc = seq[pos]
+            if nuc == fill_value:
+                filled += 1
+                nuc = consensus[pos]
+            code = np.uint64(BASE_CODES[nuc & 0xff])
+            shift = np.uint64(pos - w*64)
+            hi_word |= ((code >> np.uint64(1)) & np.uint64(1)) << shift
+            lo_word |= (code & np.uint64(1)) << shift
+            mask_word |= (code >> np.uint64(2)) << shift
+        hi[w] = hi_word
+        lo[w] = lo_word
+        if k < mask_words.shape[0] and mask_words[k] == w:
+            mask[k] = mask_word
+            k += 1
+    return filled
+
+def pack_sequence_numpy(seq, consensus, fill_value, mask_words, hi, lo, mask):
+    # same as pack_sequence_kernel (on little-endian machines) without Numba
+    nuc = np.where(seq != fill_value, seq, consensus)
+    codes = np.zeros(hi.shape[0]*64, dtype=np.uint8)
+    codes[:seq.shape[0]] = BASE_CODES[nuc.view(np.uint8)]
+    hi[:] = np.packbits((codes >> 1) & 1, bitorder='little').view(np.uint64)
+    lo[:] = np.packbits(codes & 1, bitorder='little').view(np.uint64)
+    mask[:] = np.packbits(codes >> 2, bitorder='little').view(np.uint64)[mask_words]
+    return np.count_nonzero(seq == fill_value)
+
+pack_sequence = pack_sequence_kernel if NUMBA_AVAILABLE else pack_sequence_numpy
+
+def allocate_chunk_buffers(n_seqs, align_length, n_mask_words):
+    # arrays calculate_snp_matrix packs up to n_seqs sequences into
+    return {
+        'seq': np.empty(align_length, dtype=np.int8),
+        'bitplanes': np.empty((2, n_seqs, (align_length + 63)//64), dtype=np.uint64),
+        'mask': np.empty((n_seqs, n_mask_words), dtype=np.uint64),
+        'filled_counts': np.empty(n_seqs, dtype=np.int32),
+    }
 
 # Function adapted from https://github.com/gtonkinhill/pairsnp-python
-def calculate_snp_matrix(fastafile, consensus=None, zipped=False, fill_value=110, chunk_size=0, ignore_seqs=None):
-    # This function generate a sparse matrix where differences to the consensus are coded as integers.
+def calculate_snp_matrix(fastafile, consensus=None, zipped=False, fill_value=110, chunk_size=0, ignore_seqs=None, out_buffers=None):
+    # This function packs the sequences into 2-bit bit-planes and a mask of ambiguous sites,
+    # see pack_sequence_kernel. The arrays are allocated unless out_buffers from
+    # allocate_chunk_buffers are given, the results are then views of these buffers.
     if ignore_seqs is None:
         ignore_seqs = []
 
-    row = np.empty(INITIALISATION_LENGTH)
-    col = np.empty(INITIALISATION_LENGTH, dtype=np.int64)
-    val = np.empty(INITIALISATION_LENGTH, dtype=np.int8)
-
-    r = 0
-    n_snps = 0
     nseqs = 0
-    seq_names = []
-    filled_positions = []
-    current_length = INITIALISATION_LENGTH
-
-    for record in fastafile:
-        h = record.name
-        s = str(record.seq)
+    seq_names = None
+    filled_counts = None
+    bitplanes = None
+    mask = None
+    seq = None
 
+    for h, s in fastafile:
         if h in ignore_seqs:
             continue
         if consensus is None:
-            align_length = len(s)
             # Take consensus as first sequence
             consensus = sequence_to_int_array(s, fill_value=fill_value)
-        else:
-            align_length = len(consensus)
+        align_length = len(consensus)
+
+        if bitplanes is None:
+            mask_words = ambiguous_words(consensus)
+            if out_buffers is None:
+                out_buffers = allocate_chunk_buffers(chunk_size or INITIALISATION_LENGTH, align_length, len(mask_words))
+            # every sequence is encoded into the same buffer (seq) before it is packed
+            seq, bitplanes, mask, filled_counts = (out_buffers[key] for key in ('seq', 'bitplanes', 'mask', 'filled_counts'))
+            seq_names = [None]*bitplanes.shape[1]
+        elif nseqs == bitplanes.shape[1]:
+            # the number of sequences is not known in advance without chunk_size, grow geometrically
+            bitplanes = np.concatenate([bitplanes, np.empty_like(bitplanes)], axis=1)
+            mask = np.concatenate([mask, np.empty_like(mask)])
+            filled_counts = np.concatenate([filled_counts, np.empty_like(filled_counts)])
+            seq_names.extend([None]*nseqs)
 
         nseqs +=1
-        seq_names.append(h)
+        seq_names[nseqs-1] = h
 
         if(len(s)!=align_length):
             raise ValueError('Fasta file appears to have sequences of different lengths!')
 
-        s = sequence_to_int_array(s, fill_value=fill_value)
-        snps = (consensus!=s) & (s!=fill_value)
-        right = n_snps + np.sum(snps)
-        filled_positions.append(np.where(s==fill_value)[0])
-
-        if right >= (current_length/2):
-            current_length = current_length + INITIALISATION_LENGTH
-            row.resize(current_length)
-            col.resize(current_length)
-            val.resize(current_length)
-
-        row[n_snps:right] = r
-        col[n_snps:right] = np.flatnonzero(snps)
-        val[n_snps:right] = s[snps]
-        r += 1
-        n_snps = right
+        sequence_to_int_array(s, fill_value=fill_value, out=seq)
+        filled_counts[nseqs-1] = pack_sequence(seq, consensus, fill_value, mask_words, *bitplanes[:, nseqs-1], mask[nseqs-1])
+
         if chunk_size and chunk_size==nseqs:
             break
 
     if nseqs==0:
         return None
 
-    row = row[0:right]
-    col = col[0:right]
-    val = val[0:right]
-
-    sparse_snps = sparse.csc_matrix((val, (row, col)), shape=(nseqs, align_length))
-
-    return {'snps': sparse_snps, 'consensus': consensus, 'names': seq_names, 'filled_positions': filled_positions}
-
-# Function adapted from https://github.com/gtonkinhill/pairsnp-python
-def calculate_distance_matrix(sparse_matrix_A, sparse_matrix_B, consensus):
-
-    n_seqs_A = sparse_matrix_A.shape[0]
-    n_seqs_B = sparse_matrix_B.shape[0]
-
-    d = (1*(sparse_matrix_A==97)) * (sparse_matrix_B.transpose()==97)
-    d = d + (1*(sparse_matrix_A==99) * (sparse_matrix_B.transpose()==99))
-    d = d + (1*(sparse_matrix_A==103) * (sparse_matrix_B.transpose()==103))
-    d = d + (1*(sparse_matrix_A==116) * (sparse_matrix_B.transpose()==116))
-
-    d = d.todense()
-
-    n_comp = (1*(sparse_matrix_A==110) * ((sparse_matrix_B==110).transpose())).todense()
-    d = d + n_comp
-
-    temp_total = np.zeros((n_seqs_A, n_seqs_B))
-    temp_total[:] = (1*(sparse_matrix_A>0)).sum(1)
-    temp_total += (1*(sparse_matrix_B>0)).sum(1).transpose()
-
-    total_differences_shared = (1*(sparse_matrix_A>0)) * (sparse_matrix_B.transpose()>0)
-
-    n_total = np.zeros((n_seqs_A, n_seqs_B))
-    n_sum = (1*(sparse_matrix_A==110)).sum(1)
-    n_total[:] = n_sum
-    n_total += (1*(sparse_matrix_B==110)).sum(1).transpose()
-
-    diff_n = n_total - 2*n_comp
-    d = temp_total - total_differences_shared.todense() - d - diff_n
-
-    return d
+    bitplanes = (bitplanes[0, :nseqs], bitplanes[1, :nseqs], mask[:nseqs])
+    filled_counts = filled_counts[:nseqs]
+    if not chunk_size:
+        # the whole alignment is kept for the entire run (e.g. the focal set), drop the spare rows
+        bitplanes = tuple(plane.copy() for plane in bitplanes)
+        filled_counts = filled_counts.copy()
+
+    return {'bitplanes': bitplanes, 'mask_words': mask_words, 'consensus': consensus, 'names': seq_names[:nseqs], 'filled_counts': filled_counts}
+
+def deduplicate_sequences(bitplanes):
+    # Distances only depend on the packed sequences, so identical ones need to be compared to
+    # the focal set once. Returns the indices of the first occurrence of every distinct packed
+    # sequence and, for every sequence, the position of its first occurrence in these indices.
+    first_occurrences = []
+    positions = {}
+    inverse = np.empty(bitplanes[0].shape[0], dtype=np.intp)
+    for r in range(len(inverse)):
+        h = hashlib.blake2b(digest_size=16)
+        for plane in bitplanes:
+            h.update(plane[r])
+        key = h.digest()
+        if key not in positions:
+            positions[key] = len(first_occurrences)
+            first_occurrences.append(r)
+        inverse[r] = positions[key]
+    return np.array(first_occurrences, dtype=np.intp), inverse
+
+@intrinsic
+def popcount(typingctx, x):
+    # expose LLVM's ctpop such that the distance loop compiles to hardware popcount instructions
+    sig = types.int64(types.uint64)
+    def codegen(context, builder, signature, args):
+        return builder.ctpop(args[0])
+    return sig, codegen
+
+# Number of context (A) and focal (B) sequences per tile of the distance kernel. A tile of
+# the focal set stays cache resident while it is compared to all context sequences of a tile.
+# Both sets are stored as one (n_seqs, n_words) array per plane, such that the word loop of
+# a pair of sequences streams two contiguous rows and vectorises into a register reduction.
+# Storing the focal set transposed as (n_words, n_seqs) to vectorise across focal sequences
+# instead (or interleaving the planes) is ~3x slower, because the per-pair sums then have to
+# be loaded and stored for every word.
+TILE_SIZE_A = 64
+TILE_SIZE_B = 16
+
+@njit(parallel=True, fastmath=True, boundscheck=False, nogil=True, cache=True)
+def closest_match_kernel(hi_A, lo_A, mask_A, rows_A, hi_B, lo_B, mask_B, mask_words, penalty_B, best_dist, best_idx):
+    # only the sequences of A in rows_A are compared, results are in the order of rows_A
+    n_seqs_A = rows_A.shape[0]
+    n_words = hi_A.shape[1]
+    n_seqs_B = hi_B.shape[0]
+    for tile in prange((n_seqs_A + TILE_SIZE_A - 1)//TILE_SIZE_A):
+        i_start = tile*TILE_SIZE_A
+        i_end = min(i_start + TILE_SIZE_A, n_seqs_A)
+        best_score = np.empty(TILE_SIZE_A)
+        for j_start in range(0, n_seqs_B, TILE_SIZE_B):
+            j_end = min(j_start + TILE_SIZE_B, n_seqs_B)
+            for i in range(i_start, i_end):
+                r = rows_A[i]
+                for j in range(j_start, j_end):
+                    acc = 0
+                    for w in range(n_words):
+                        acc += popcount((hi_A[r, w]^hi_B[j, w]) | (lo_A[r, w]^lo_B[j, w]))
+                    # ambiguous sites are coded as 'a', add those that only differ in the mask
+                    for k in range(mask_words.shape[0]):
+                        w = mask_words[k]
+                        acc += popcount((mask_A[r, k]^mask_B[j, k]) & ~((hi_A[r, w]^hi_B[j, w]) | (lo_A[r, w]^lo_B[j, w])))
+                    # keep the first focal sequence with the lowest score, like np.argmin
+                    score = acc + penalty_B[j]
+                    if j == 0 or score < best_score[i - i_start]:
+                        best_score[i - i_start] = score
+                        best_dist[i] = acc
+                        best_idx[i] = j
+
+if hasattr(np, 'bitwise_count'):
+    def popcount_sum(x):
+        return np.bitwise_count(x).sum(-1)
+else:
+    # NumPy < 2.0 lacks a popcount ufunc, count the bits of every byte instead
+    BYTE_POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+    def popcount_sum(x):
+        return BYTE_POPCOUNT[x.view(np.uint8)].sum(-1, dtype=np.int64)
+
+def closest_match_numpy(hi_A, lo_A, mask_A, rows_A, hi_B, lo_B, mask_B, mask_words, penalty_B, best_dist, best_idx):
+    # same as closest_match_kernel without Numba, one tile of distances at a time
+    n_seqs_A = rows_A.shape[0]
+    n_seqs_B = hi_B.shape[0]
+    for i_start in range(0, n_seqs_A, TILE_SIZE_A):
+        i_end = min(i_start + TILE_SIZE_A, n_seqs_A)
+        rows = rows_A[i_start:i_end]
+        tile_hi_A, tile_lo_A, tile_mask_A = hi_A[rows, None], lo_A[rows, None], mask_A[rows, None]
+        d = np.empty((i_end - i_start, n_seqs_B), dtype=np.int64)
+        for j_start in range(0, n_seqs_B, TILE_SIZE_B):
+            j_end = min(j_start + TILE_SIZE_B, n_seqs_B)
+            diff = (tile_hi_A^hi_B[None, j_start:j_end]) | (tile_lo_A^lo_B[None, j_start:j_end])
+            d[:, j_start:j_end] = popcount_sum(diff) + popcount_sum(
+                (tile_mask_A^mask_B[None, j_start:j_end]) & ~diff[:, :, mask_words]
+            )
+        closest = np.argmin(d + penalty_B, axis=1)
+        best_idx[i_start:i_end] = closest
+        best_dist[i_start:i_end] = d[np.arange(i_end - i_start), closest]
+
+def find_closest_matches(bitplanes_A, bitplanes_B, mask_words, penalty_B, rows_A=None, best_dist=None, best_idx=None):
+    # For every sequence in A, find the sequence in B with the lowest distance plus penalty. The
+    # distance is the number of sites at which the sequences differ, counting only sites that
+    # differ from the consensus. Only the best match is kept, the distance matrix is never stored.
+    # If given, only the sequences of A in rows_A are compared and the results are in their order.
+    # The results are written to best_dist and best_idx if given.
+    if rows_A is None:
+        rows_A = np.arange(bitplanes_A[0].shape[0])
+    n_seqs_A = len(rows_A)
+    if best_dist is None:
+        best_dist = np.empty(n_seqs_A, dtype=np.int32)
+    if best_idx is None:
+        best_idx = np.empty(n_seqs_A, dtype=np.int32)
+    kernel = closest_match_kernel if NUMBA_AVAILABLE else closest_match_numpy
+    kernel(*bitplanes_A, rows_A, *bitplanes_B, mask_words, penalty_B, best_dist, best_idx)
+    return best_dist, best_idx
+
+# CUDA version of closest_match_kernel. Every block compares a tile of CUDA_TILE_SIZE context
+# sequences (threadIdx.y) to CUDA_TILE_SIZE focal sequences at a time (threadIdx.x), staging
+# CUDA_TILE_WORDS words of both tiles in shared memory. Each warp holds one context sequence,
+# reduces the scores of its lanes with shuffles and lane 0 keeps the running best match.
+CUDA_TILE_SIZE = 32
+CUDA_TILE_WORDS = 16
+CUDA_CLOSEST_MATCH_SOURCE = r'''
+#define TILE_SIZE %(tile_size)d
+#define TILE_WORDS %(tile_words)d
+
+extern "C" __global__ void closest_match(
+    const unsigned long long* hi_A, const unsigned long long* lo_A, const unsigned long long* mask_A,
+    const unsigned long long* hi_B, const unsigned long long* lo_B, const unsigned long long* mask_B,
+    const long long* mask_words, const double* penalty_B, const int n_seqs_A, const int n_seqs_B,
+    const int n_words, const int n_mask_words, int* best_dist, int* best_idx)
+{
+    __shared__ unsigned long long tile_A[2][TILE_SIZE][TILE_WORDS];
+    // padded to avoid bank conflicts, the lanes of a warp read different rows of tile_B
+    __shared__ unsigned long long tile_B[2][TILE_SIZE][TILE_WORDS + 1];
+
+    const int tx = threadIdx.x;
+    const int ty = threadIdx.y;
+    const int i_start = blockIdx.x*TILE_SIZE;
+    const int i = i_start + ty;
+
+    double best_score = 0.0;
+    int best_d = 0;
+    int best_j = n_seqs_B;
+
+    for (int j_start = 0; j_start < n_seqs_B; j_start += TILE_SIZE) {
+        int acc = 0;
+        for (int w_start = 0; w_start < n_words; w_start += TILE_WORDS) {
+            for (int k = ty*TILE_SIZE + tx; k < TILE_SIZE*TILE_WORDS; k += TILE_SIZE*TILE_SIZE) {
+                const int r = k / TILE_WORDS;
+                const int c = k %% TILE_WORDS;
+                const int w = w_start + c;
+                // words beyond the ends are zero for both tiles and do not add to the distance
+                const bool valid_A = (i_start + r < n_seqs_A) && (w < n_words);
+                const bool valid_B = (j_start + r < n_seqs_B) && (w < n_words);
+                const size_t a = (size_t)(i_start + r)*n_words + w;
+                const size_t b = (size_t)(j_start + r)*n_words + w;
+                tile_A[0][r][c] = valid_A ? hi_A[a] : 0ULL;
+                tile_A[1][r][c] = valid_A ? lo_A[a] : 0ULL;
+                tile_B[0][r][c] = valid_B ? hi_B[b] : 0ULL;
+                tile_B[1][r][c] = valid_B ? lo_B[b] : 0ULL;
+            }
+            __syncthreads();
+            for (int c = 0; c < TILE_WORDS; c++) {
+                acc += __popcll((tile_A[0][ty][c] ^ tile_B[0][tx][c]) | (tile_A[1][ty][c] ^ tile_B[1][tx][c]));
+            }
+            __syncthreads();
+        }
+
+        int j = j_start + tx;
+        if (i < n_seqs_A && j < n_seqs_B) {
+            // ambiguous sites are coded as 'a', add those that only differ in the mask
+            for (int k = 0; k < n_mask_words; k++) {
+                const size_t a = (size_t)i*n_words + mask_words[k];
+                const size_t b = (size_t)j*n_words + mask_words[k];
+                acc += __popcll((mask_A[(size_t)i*n_mask_words + k] ^ mask_B[(size_t)j*n_mask_words + k])
+                                & ~((hi_A[a] ^ hi_B[b]) | (lo_A[a] ^ lo_B[b])));
+            }
+        }
+
+        // argmin over the lanes of the warp, ties are resolved to the lowest focal index
+        int d = acc;
+        double score = (j < n_seqs_B) ? acc + penalty_B[j] : 0.0;
+        if (j >= n_seqs_B) j = n_seqs_B;
+        for (int offset = TILE_SIZE/2; offset > 0; offset /= 2) {
+            const double other_score = __shfl_down_sync(0xffffffff, score, offset);
+            const int other_j = __shfl_down_sync(0xffffffff, j, offset);
+            const int other_d = __shfl_down_sync(0xffffffff, d, offset);
+            if (other_j < n_seqs_B && (j >= n_seqs_B || other_score < score || (other_score == score && other_j < j))) {
+                score = other_score;
+                j = other_j;
+                d = other_d;
+            }
+        }
+        if (tx == 0 && j < n_seqs_B && (best_j >= n_seqs_B || score < best_score)) {
+            best_score = score;
+            best_d = d;
+            best_j = j;
+        }
+    }
+
+    if (tx == 0 && i < n_seqs_A) {
+        best_dist[i] = best_d;
+        best_idx[i] = best_j;
+    }
+}
+'''
+
+@lru_cache(maxsize=None)
+def cuda_closest_match_kernel():
+    source = CUDA_CLOSEST_MATCH_SOURCE % {'tile_size': CUDA_TILE_SIZE, 'tile_words': CUDA_TILE_WORDS}
+    return cupy.RawKernel(source, 'closest_match')
+
+def gpu_available():
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        return False
+
+def to_device(bitplanes):
+    # copy bit-planes (numpy or cupy) to the GPU as one contiguous array per plane
+    return [cupy.ascontiguousarray(cupy.asarray(plane)) for plane in bitplanes]
+
+def find_closest_matches_gpu(bitplanes_A, bitplanes_B, mask_words, penalty_B, rows_A=None):
+    # same as find_closest_matches on the GPU, bitplanes_B and penalty_B may already be on the device
+    if rows_A is not None:
+        # only copy the compared sequences to the device
+        bitplanes_A = [plane[rows_A] for plane in bitplanes_A]
+    n_seqs_A, n_words = bitplanes_A[0].shape
+    n_seqs_B = bitplanes_B[0].shape[0]
+    best_dist = cupy.empty(n_seqs_A, dtype=cupy.int32)
+    best_idx = cupy.empty(n_seqs_A, dtype=cupy.int32)
+    cuda_closest_match_kernel()(
+        ((n_seqs_A + CUDA_TILE_SIZE - 1)//CUDA_TILE_SIZE,), (CUDA_TILE_SIZE, CUDA_TILE_SIZE),
+        (*to_device(bitplanes_A), *to_device(bitplanes_B), cupy.asarray(mask_words, dtype=cupy.int64),
+         cupy.asarray(penalty_B, dtype=cupy.float64), np.int32(n_seqs_A), np.int32(n_seqs_B),
+         np.int32(n_words), np.int32(len(mask_words)), best_dist, best_idx)
+    )
+    return best_dist.get(), best_idx.get()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -144,14 +480,24 @@ if __name__ == '__main__':
     parser.add_argument("--ignore-seqs", type = str, nargs='+', help="sequences to ignore in distance calculation")
     parser.add_argument("--focal-alignment", type = str, required=True, help="focal sample of sequences")
     parser.add_argument("--chunk-size", type=int, default=10000, help="number of samples in the global alignment to process at once. Reduce this number to reduce memory usage at the cost of increased run-time.")
+    parser.add_argument("--nthreads", type=int, default=1, help="number of threads used to calculate distances")
+    # Experimental and hidden from the help until validated against the CPU kernels on a GPU
+    parser.add_argument("--gpu", action="store_true", help=argparse.SUPPRESS)
     parser.add_argument("--output", type=str, required=True, help="FASTA file of output alignment")
     args = parser.parse_args()
 
+    if NUMBA_AVAILABLE:
+        set_num_threads(max(1, min(args.nthreads, config.NUMBA_NUM_THREADS)))
+    else:
+        print("WARNING: Numba is not installed, falling back to slower NumPy implementations.", file=sys.stderr)
+
     # load entire alignment and the alignment of focal sequences (upper case -- probably not necessary)
-    ref = sequence_to_int_array(SeqIO.read(args.reference, 'fasta').seq)
+    reference = read_fasta(args.reference)
+    ref = sequence_to_int_array(next(reference)[1])
+    reference.close()
     alignment_length = len(ref)
 
-    focal_seqs = read_sequences(args.focal_alignment)
+    focal_seqs = read_fasta(args.focal_alignment)
     focal_seqs_dict = calculate_snp_matrix(focal_seqs, consensus = ref, ignore_seqs=args.ignore_seqs)
 
     if focal_seqs_dict is None:
@@ -162,37 +508,73 @@ if __name__ == '__main__':
         )
         sys.exit(1)
 
-    seqs = read_sequences(args.alignment)
+    # number of masked sites in the focal set as a fraction of the alignment length, which is
+    # added to the distances inside the kernel to prefer more complete focal sequences
+    focal_penalty = focal_seqs_dict['filled_counts']/alignment_length
+    # words with ambiguous sites of the reference, shared by focal and context sequences
+    mask_words = focal_seqs_dict['mask_words']
+
+    if args.gpu and not gpu_available():
+        print("WARNING: No CUDA GPU available through CuPy, calculating distances on the CPU.", file=sys.stderr)
+        args.gpu = False
+    if args.gpu:
+        # the focal set stays on the device for all chunks
+        focal_bitplanes = to_device(focal_seqs_dict['bitplanes'])
+        focal_penalty = cupy.asarray(focal_penalty)
+
+    seqs = read_fasta(args.alignment)
 
     # export priorities
-    fh_out = open(args.output, 'w')
+    fh_out = open(args.output, 'w', buffering=1<<20)
     fh_out.write('strain\tclosest strain\tdistance\n')
 
     chunk_size=args.chunk_size
     chunk_count = 0
-    while True:
-        context_seqs_dict = calculate_snp_matrix(seqs, consensus=ref, chunk_size=chunk_size)
-        if context_seqs_dict is None:
-            break
-
-        print("Reading the alignments.", chunk_count*chunk_size)
-
-        # calculate number of masked sites in either set
-        mask_count_focal = np.array([len(x) for x in focal_seqs_dict['filled_positions']])
-        mask_count_context = {s: len(x) for s,x in zip(context_seqs_dict['names'], context_seqs_dict['filled_positions'])}
-
-        # for each context sequence, calculate minimal distance to focal set, weigh with number of N/- to pick best sequence
-        d = np.array(calculate_distance_matrix(context_seqs_dict['snps'], focal_seqs_dict['snps'], consensus = context_seqs_dict['consensus']))
-        closest_match = np.argmin(d+mask_count_focal/alignment_length, axis=1)
-        print("Done finding closest matches.")
-
-        minimal_distance_to_focal_set = {}
-        for context_index, focal_index in enumerate(closest_match):
-            minimal_distance_to_focal_set[context_seqs_dict['names'][context_index]] = (d[context_index, focal_index], focal_seqs_dict["names"][focal_index])
-
-        for seqid in minimal_distance_to_focal_set:
-            fh_out.write(f"{seqid}\t{minimal_distance_to_focal_set[seqid][1]}\t{minimal_distance_to_focal_set[seqid][0]}\n")
-
-        chunk_count += 1
+    # Two sets of buffers are used in turns: one holds the chunk whose distances are calculated
+    # while the next chunk is read and packed into the other in a separate thread. The Numba
+    # kernels release the GIL, only parsing the FASTA records holds it.
+    chunk_buffers = [allocate_chunk_buffers(chunk_size or INITIALISATION_LENGTH, alignment_length, len(mask_words)) for _ in range(2)]
+    best_dist = np.empty(chunk_size or INITIALISATION_LENGTH, dtype=np.int32)
+    best_idx = np.empty_like(best_dist)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_chunk = reader.submit(calculate_snp_matrix, seqs, consensus=ref, chunk_size=chunk_size, out_buffers=chunk_buffers[0])
+        while True:
+            context_seqs_dict = next_chunk.result()
+            if context_seqs_dict is None:
+                break
+            next_chunk = reader.submit(calculate_snp_matrix, seqs, consensus=ref, chunk_size=chunk_size, out_buffers=chunk_buffers[(chunk_count + 1) % 2])
+
+            print("Reading the alignments.", chunk_count*chunk_size)
+
+            # only compare distinct sequences to the focal set, the kernels read them in place
+            unique_seqs, inverse = deduplicate_sequences(context_seqs_dict['bitplanes'])
+            n_unique = len(unique_seqs)
+            if n_unique > len(best_dist):
+                # the whole alignment is read at once without chunk_size
+                best_dist = np.empty(n_unique, dtype=np.int32)
+                best_idx = np.empty_like(best_dist)
+            print(f"Comparing {n_unique} distinct sequences to the focal set.")
+
+            # for each context sequence, calculate minimal distance to focal set, weigh with number of N/- to pick best sequence
+            if args.gpu:
+                closest_distance, closest_match = find_closest_matches_gpu(context_seqs_dict['bitplanes'], focal_bitplanes, mask_words, focal_penalty, rows_A=unique_seqs)
+            else:
+                closest_distance, closest_match = find_closest_matches(
+                    context_seqs_dict['bitplanes'], focal_seqs_dict['bitplanes'], mask_words, focal_penalty,
+                    rows_A=unique_seqs, best_dist=best_dist[:n_unique], best_idx=best_idx[:n_unique]
+                )
+            if n_unique < len(inverse):
+                closest_distance = closest_distance[inverse]
+                closest_match = closest_match[inverse]
+            print("Done finding closest matches.")
+
+            # write the whole chunk at once
+            focal_names = focal_seqs_dict['names']
+            fh_out.write("".join([
+                f"{seqid}\t{focal_names[focal_index]}\t{distance}\n"
+                for seqid, focal_index, distance in zip(context_seqs_dict['names'], closest_match.tolist(), closest_distance.tolist())
+            ]))
+
+            chunk_count += 1
 
     fh_out.close()
@@ -377,8 +377,11 @@ rule proximity_score:
     params:
         chunk_size=10000,
         ignore_seqs = config['refine']['root']
+    threads: 4
     resources:
-        # Memory scales at ~0.15 MB * chunk_size (e.g., 0.15 MB * 10000 = 1.5GB).
+        # Memory scales at ~7.5 kB per packed sequence. Two chunks are held at once (one is read while
+        # the other is compared), i.e. ~15 kB per sequence in a chunk (e.g., 15 kB * 10000 = 150MB),
+        # plus ~7.5 kB per sequence in the focal set.
         mem_mb=4000
     conda: config["conda_environment"]
     shell:
@@ -389,6 +392,7 @@ rule proximity_score:
             --focal-alignment {input.focal_alignment} \
             --ignore-seqs {params.ignore_seqs} \
             --chunk-size {params.chunk_size} \
+            --nthreads {threads} \
             --output {output.proximities} 2>&1 | tee {log}
         """
 